@@ -1,11 +1,26 @@
+import ctypes
+import json
+import mmap
 import os
 import platform
+import re
 import subprocess
 import tempfile
+import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from typing import List
 
+try:
+    import win32print  # type: ignore
+except ImportError:
+    win32print = None
+
+try:
+    import cups  # type: ignore
+except ImportError:
+    cups = None
+
 """
 Universal Label Printer
 =======================
@@ -28,30 +43,114 @@ Features:
   operating system and lets the user choose one.
 * **Test mode**: Enabled by default; prints only the first label (`^XA…^XZ` block).
   Disable test mode via the checkbox to print all labels in the file.
-* **Cross‑platform**: Uses `pywin32` on Windows and the `lp` command on
-  macOS/Linux. There is no need to hardcode a printer name.
+* **Cross‑platform**: Uses the Windows spooler API on Windows and CUPS on
+  macOS/Linux, through `pycups` when it is installed or the `lp`/`lpstat`
+  commands otherwise. There is no need to hardcode a printer name.
 
-Note: On Windows, this script depends on the `pywin32` package to access
-`win32print`. Ensure it is installed when running the script or bundling it
-into an executable.
+Note: On Windows, listing printers depends on the `pywin32` package to access
+`win32print`; printing itself calls `winspool.drv` through `ctypes`. Ensure
+`pywin32` is installed when running the script or bundling it into an
+executable.
 """
 
 # Global: hold selected printer name and test mode state
 selected_printer = None  # type: str
 
+# Windows spooler handle kept open for the selected printer between prints
+_printer_handle = None
+_printer_handle_name = None  # type: str
+
+# Buffer the print payload is assembled in. It is overwritten in place and
+# only ever grows, so repeated prints of similar size reuse one allocation.
+_PAYLOAD_BUF = bytearray()
+
+# CUPS connection reused between prints when pycups is available
+_cups_conn = None
+
+# The host OS does not change at runtime, so detect it once
+_IS_WIN = platform.system().lower().startswith("win")
+
+if _IS_WIN:
+    from ctypes import wintypes
+
+    # RAW printing talks to winspool.drv directly instead of going through pywin32
+    _PRINTER_ACCESS_USE = 0x00000008
+
+    class _PRINTER_DEFAULTS(ctypes.Structure):
+        _fields_ = [
+            ("pDatatype", wintypes.LPWSTR),
+            ("pDevMode", wintypes.LPVOID),
+            ("DesiredAccess", wintypes.DWORD),
+        ]
+
+    class _DOC_INFO_1(ctypes.Structure):
+        _fields_ = [
+            ("pDocName", wintypes.LPWSTR),
+            ("pOutputFile", wintypes.LPWSTR),
+            ("pDatatype", wintypes.LPWSTR),
+        ]
+
+    def _winspool_check(result, func, args):
+        """ctypes errcheck hook: turn a zero return into an ``OSError``."""
+        if not result:
+            raise ctypes.WinError(ctypes.get_last_error())
+        return result
+
+    _winspool = ctypes.WinDLL("winspool.drv", use_last_error=True)
+    for _name, _argtypes, _restype in (
+        ("OpenPrinterW", [wintypes.LPWSTR, ctypes.POINTER(wintypes.HANDLE), ctypes.POINTER(_PRINTER_DEFAULTS)], wintypes.BOOL),
+        ("StartDocPrinterW", [wintypes.HANDLE, wintypes.DWORD, ctypes.POINTER(_DOC_INFO_1)], wintypes.DWORD),
+        ("StartPagePrinter", [wintypes.HANDLE], wintypes.BOOL),
+        ("WritePrinter", [wintypes.HANDLE, wintypes.LPVOID, wintypes.DWORD, ctypes.POINTER(wintypes.DWORD)], wintypes.BOOL),
+        ("EndPagePrinter", [wintypes.HANDLE], wintypes.BOOL),
+        ("EndDocPrinter", [wintypes.HANDLE], wintypes.BOOL),
+        ("ClosePrinter", [wintypes.HANDLE], wintypes.BOOL),
+    ):
+        _func = getattr(_winspool, _name)
+        _func.argtypes = _argtypes
+        _func.restype = _restype
+        _func.errcheck = _winspool_check
+    del _name, _argtypes, _restype, _func
+
+# Last known printer list, shown at startup while the real one is loading.
+# Kept in the per-user cache directory so users never share or hijack it.
+if _IS_WIN:
+    _CACHE_DIR = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), "AppData", "Local")
+else:
+    _CACHE_DIR = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+_CACHE_DIR = os.path.join(_CACHE_DIR, "imprimir")
+_PRINTER_CACHE = os.path.join(_CACHE_DIR, "printers.json")
+
+# Characters str.strip() treats as whitespace in latin-1 text
+_ZPL_WHITESPACE = b"\t\n\x0b\x0c\r\x1c\x1d\x1e\x1f \x85\xa0"
+
+# One label: everything up to and including the next ^XZ, so commands outside
+# ^XA…^XZ (e.g. ~DG downloads) travel with the block that follows them.
+# Whitespace-only blocks match the first branch and leave the group empty.
+_LABEL_RE = re.compile(
+    b"[" + re.escape(_ZPL_WHITESPACE) + rb"]*\^XZ|(.*?\^XZ)", re.DOTALL
+)
+
 
 def list_printers() -> List[str]:
     """Return a list of installed printer names on the host system."""
-    system_name = platform.system().lower()
     printers = []
-    if system_name.startswith("win"):
-        try:
-            import win32print  # type: ignore
-        except ImportError:
+    if _IS_WIN:
+        if win32print is None:
             return []
-        for p in win32print.EnumPrinters(win32print.PRINTER_ENUM_LOCAL | win32print.PRINTER_ENUM_CONNECTIONS):
-            printers.append(p[2])
+        # Level 4 only returns names, so the spooler does not have to open
+        # every printer the way it does to fill PRINTER_INFO_2
+        for p in win32print.EnumPrinters(
+            win32print.PRINTER_ENUM_LOCAL | win32print.PRINTER_ENUM_CONNECTIONS, None, 4
+        ):
+            printers.append(p["pPrinterName"] if isinstance(p, dict) else p[0])
     else:
+        # Ask CUPS directly when pycups is available, saving the lpstat fork
+        if cups is not None:
+            try:
+                return list(cups.Connection().getPrinters())
+            except Exception:
+                pass
         # Use lpstat to list printers on Unix systems
         try:
             result = subprocess.run(
@@ -62,87 +161,257 @@ def list_printers() -> List[str]:
                 check=False,
             )
             for line in result.stdout.splitlines():
-                parts = line.split()
-                if parts and parts[0] == "printer":
-                    printers.append(parts[1])
+                # Only the name is needed, don't tokenize the status text after it
+                if line.startswith("printer "):
+                    printers.append(line.split(None, 2)[1])
         except Exception:
             pass
     return printers
 
 
-def split_zpl_labels(content: str) -> List[str]:
-    """Split raw ZPL content into individual label blocks."""
-    parts = content.split("^XZ")
+def _read_printer_cache() -> List[str]:
+    """Return the printer names saved by the previous run, if any."""
+    try:
+        with open(_PRINTER_CACHE, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if not isinstance(cached, list):
+        return []
+    return [name for name in cached if isinstance(name, str)]
+
+
+def _write_printer_cache(printers: List[str]) -> None:
+    """Save the printer names for the next run, replacing the cache atomically."""
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=_CACHE_DIR, suffix=".tmp")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(printers, f)
+        os.replace(tmp_path, _PRINTER_CACHE)
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
+def split_zpl_labels(content, first_only: bool = False) -> List[bytes]:
+    """Split raw ZPL content into individual label blocks.
+
+    Each block runs up to and including its ``^XZ`` and is located by
+    ``_LABEL_RE``, so the scan runs inside the regex engine. Whitespace-only
+    blocks are skipped and an unterminated block at the end is closed with
+    ``^XZ``. ``content`` may be ``bytes`` or an ``mmap``; with ``first_only``
+    the scan stops at the first label, otherwise all labels are collected by a
+    single ``findall`` call.
+    """
     labels = []
-    for part in parts:
-        if part.strip():
-            labels.append(part + "^XZ\n")
+    end = content.rfind(b"^XZ")
+    # Stop the scan at the last terminator: past it the lazy group can never
+    # match and would rescan to the end of the data from every position
+    if end >= 0 and first_only:
+        for m in _LABEL_RE.finditer(content, 0, end + 3):
+            if m.group(1):
+                return [m.group(1)]
+    elif end >= 0:
+        # findall and filter build the list in C, with no bytecode per label
+        labels = list(filter(None, _LABEL_RE.findall(content, 0, end + 3)))
+    # Trailing block without a terminator: close it like the others
+    tail = content[end + 3 if end >= 0 else 0:]
+    if tail.strip(_ZPL_WHITESPACE):
+        labels.append(tail + b"^XZ")
     return labels
 
 
-def send_raw_to_printer(printer: str, data: str) -> None:
-    """Send raw ZPL data to the specified printer name."""
-    system_name = platform.system().lower()
-    if system_name.startswith("win"):
+def _get_handle(printer: str):
+    """Return a spooler handle for ``printer``, opening it only when needed."""
+    global _printer_handle, _printer_handle_name
+    if _printer_handle is not None and _printer_handle_name == printer:
+        return _printer_handle
+    _close_handle()
+    # Ask only for the rights and datatype a RAW job needs
+    defaults = _PRINTER_DEFAULTS("RAW", None, _PRINTER_ACCESS_USE)
+    handle = wintypes.HANDLE()
+    try:
+        _winspool.OpenPrinterW(printer, ctypes.byref(handle), ctypes.byref(defaults))
+    except OSError as exc:
+        raise RuntimeError(
+            f"Could not open printer '{printer}'. Check the name and driver."
+        ) from exc
+    _printer_handle = handle
+    _printer_handle_name = printer
+    return _printer_handle
+
+
+def _close_handle() -> None:
+    """Close the cached spooler handle, if one is open."""
+    global _printer_handle, _printer_handle_name
+    if _printer_handle is None:
+        return
+    try:
+        _winspool.ClosePrinter(_printer_handle)
+    except OSError:
+        pass
+    _printer_handle = None
+    _printer_handle_name = None
+
+
+def _get_cups_conn():
+    """Return the shared CUPS connection, or None when pycups can't provide one."""
+    global _cups_conn
+    if _cups_conn is None and cups is not None:
         try:
-            import win32print  # type: ignore
-        except ImportError as exc:
-            raise RuntimeError(
-                "pywin32 is required on Windows to send raw data to printers"
-            ) from exc
-        # Open printer
+            _cups_conn = cups.Connection()
+        except (cups.IPPError, RuntimeError):
+            return None
+    return _cups_conn
+
+
+def _cups_print(conn, printer: str, data: bytes) -> None:
+    """Submit ``data`` as a single RAW job over the shared CUPS connection."""
+    global _cups_conn
+    raw = "application/vnd.cups-raw"
+    try:
+        try:
+            job_id = conn.createJob(printer, "Label Print", {"document-format": raw})
+        except (cups.IPPError, RuntimeError):
+            # Nothing has been sent yet, so if the cached connection went stale
+            # while the app sat idle it is safe to retry once on a fresh one
+            _cups_conn = None
+            conn = _get_cups_conn()
+            if conn is None:
+                raise
+            job_id = conn.createJob(printer, "Label Print", {"document-format": raw})
+    except (cups.IPPError, RuntimeError) as exc:
+        _cups_conn = None
+        raise RuntimeError(f"Print error: {exc}") from exc
+    try:
+        if conn.startDocument(printer, job_id, "labels", raw, 1) != cups.HTTP_CONTINUE:
+            raise RuntimeError("could not start the document")
+        if conn.writeRequestData(data, len(data)) != cups.HTTP_CONTINUE:
+            raise RuntimeError("could not send the label data")
+        conn.finishDocument(printer)
+    except (cups.IPPError, RuntimeError) as exc:
+        # Reconnect on the next print in case the connection went bad
+        _cups_conn = None
+        # Don't leave a partial job queued on the server
         try:
-            handle = win32print.OpenPrinter(printer)
-        except win32print.error as exc:
+            conn.cancelJob(job_id)
+        except (cups.IPPError, RuntimeError) as cancel_exc:
             raise RuntimeError(
-                f"Could not open printer '{printer}'. Check the name and driver."
+                f"Print error: {exc}. Job {job_id} could not be cancelled"
+                f" ({cancel_exc}); check the printer queue."
             ) from exc
+        raise RuntimeError(f"Print error: {exc}") from exc
+
+
+def _fill_payload(labels: List[bytes]) -> memoryview:
+    """Write ``labels``, each followed by a newline, into ``_PAYLOAD_BUF``.
+
+    Returns a view of the written bytes; release it before the next print so
+    the buffer can grow again.
+    """
+    size = sum(map(len, labels)) + len(labels)
+    if len(_PAYLOAD_BUF) < size:
+        _PAYLOAD_BUF.extend(bytes(size - len(_PAYLOAD_BUF)))
+    view = memoryview(_PAYLOAD_BUF)
+    pos = 0
+    for label in labels:
+        end = pos + len(label)
+        view[pos:end] = label
+        view[end] = 0x0A  # b"\n"
+        pos = end + 1
+    return view[:size]
+
+
+def send_raw_to_printer(printer: str, labels: List[bytes]) -> None:
+    """Send ZPL label blocks to the specified printer name as one RAW job."""
+    if not _IS_WIN:
+        # macOS/Linux: send the job over IPP with pycups, without spawning lp
+        conn = _get_cups_conn()
+        if conn is not None:
+            # pycups only accepts bytes, not a view of the shared buffer, so
+            # the payload is joined in C and sent with a single write
+            _cups_print(conn, printer, b"\n".join(labels + [b""]))
+            return
+    with _fill_payload(labels) as data:
+        _send_payload(printer, data)
+
+
+def _send_payload(printer: str, data: memoryview) -> None:
+    """Send an assembled payload through the spooler (Windows) or ``lp``."""
+    if _IS_WIN:
+        handle = _get_handle(printer)
+        doc_info = _DOC_INFO_1("Label Print", None, "RAW")
+        written = wintypes.DWORD()
+        # The payload is passed by pointer, it is not copied
+        buf = (ctypes.c_char * len(data)).from_buffer(data)
         try:
-            job = win32print.StartDocPrinter(handle, 1, ("Label Print", None, "RAW"))
-            win32print.StartPagePrinter(handle)
-            win32print.WritePrinter(handle, data.encode("latin-1"))
-            win32print.EndPagePrinter(handle)
-            win32print.EndDocPrinter(handle)
+            _winspool.StartDocPrinterW(handle, 1, ctypes.byref(doc_info))
+            _winspool.StartPagePrinter(handle)
+            _winspool.WritePrinter(handle, buf, len(data), ctypes.byref(written))
+            _winspool.EndPagePrinter(handle)
+            _winspool.EndDocPrinter(handle)
+        except OSError as exc:
+            # Don't reuse a handle that may have gone stale
+            _close_handle()
+            raise RuntimeError(f"Print error: {exc}") from exc
         finally:
-            win32print.ClosePrinter(handle)
+            # Release the buffer export so _PAYLOAD_BUF can be resized later
+            del buf
+        if written.value != len(data):
+            raise RuntimeError(
+                f"Print error: only {written.value} of {len(data)} bytes were sent."
+            )
     else:
-        # macOS/Linux: write to temp file and invoke lp
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".zpl") as tmp:
-            tmp.write(data.encode("latin-1"))
-            tmp_path = tmp.name
-        try:
-            result = subprocess.run(
-                ["lp", "-d", printer, "-o", "raw", tmp_path],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=False,
+        # Without pycups, pipe the data straight into lp
+        result = subprocess.run(
+            ["lp", "-d", printer, "-o", "raw"],
+            input=data,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=False,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(
+                f"Print error: {result.stderr.decode(errors='replace').strip()}"
             )
-            if result.returncode != 0:
-                raise RuntimeError(f"Print error: {result.stderr.strip()}")
-        finally:
-            try:
-                os.unlink(tmp_path)
-            except OSError:
-                pass
 
 
 def print_labels(file_path: str, printer: str, test_only: bool) -> None:
-    """Read a ZPL file, split into labels, and send to the printer."""
+    """Read a ZPL file, split into labels, and send to the printer.
+
+    The file is memory-mapped and split in place, so it is never read into an
+    intermediate buffer; only the label blocks are copied out of the mapping
+    and then once more into the print payload.
+    """
     try:
-        with open(file_path, "r", encoding="latin-1") as f:
-            content = f.read()
+        f = open(file_path, "rb")
     except OSError as exc:
         raise RuntimeError(f"Could not read file: {file_path}") from exc
-
-    if "^XA" not in content:
-        raise RuntimeError("The file does not contain ZPL commands (missing ^XA).")
-    labels = split_zpl_labels(content)
-    if not labels:
-        raise RuntimeError("No labels found in the file.")
-    to_print = labels[:1] if test_only else labels
-    for label in to_print:
-        send_raw_to_printer(printer, label)
+    with f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            raise RuntimeError("The file does not contain ZPL commands (missing ^XA).") from None
+        except OSError as exc:
+            raise RuntimeError(f"Could not read file: {file_path}") from exc
+        with mm:
+            # Reject files that are clearly not ZPL before splitting anything
+            if mm.rfind(b"^XZ") < 0 and mm.find(b"^XA") < 0:
+                raise RuntimeError("The file does not contain ZPL commands (missing ^XA).")
+            # In test mode the scan stops as soon as the first label is complete
+            labels = split_zpl_labels(mm, first_only=test_only)
+            # The first label normally holds ^XA; only scan the file otherwise
+            if not (labels and b"^XA" in labels[0]) and mm.find(b"^XA") < 0:
+                raise RuntimeError("The file does not contain ZPL commands (missing ^XA).")
+    # Submit every label in a single print job instead of one job per label
+    send_raw_to_printer(printer, labels)
 
 
 def browse_and_print(printers: List[str], test_var: tk.IntVar, file_label: tk.Label):
@@ -175,12 +444,57 @@ def browse_and_print(printers: List[str], test_var: tk.IntVar, file_label: tk.La
 def on_printer_select(event, printer_var: tk.StringVar):
     """Update the selected_printer global when the user selects a printer from the dropdown."""
     global selected_printer
+    if printer_var.get() != selected_printer:
+        _close_handle()
     selected_printer = printer_var.get()
 
 
+def _populate_menu(printer_menu: tk.OptionMenu, printer_var: tk.StringVar, printers: List[str]):
+    """Fill the printer dropdown with the given names and keep a valid selection."""
+    global selected_printer
+    menu = printer_menu["menu"]
+    menu.delete(0, "end")
+    for name in printers:
+        menu.add_command(
+            label=name,
+            command=lambda name=name: (printer_var.set(name), on_printer_select(None, printer_var)),
+        )
+    if printers:
+        # Keep the user's choice if it survived a refresh of the list
+        if selected_printer not in printers:
+            selected_printer = printers[0]
+        printer_var.set(selected_printer)
+        printer_menu.config(state="normal")
+    else:
+        selected_printer = None
+        printer_var.set("Nenhuma impressora encontrada")
+        printer_menu.config(state="disabled")
+
+
+def _load_printers_bg(root: tk.Tk, printer_menu: tk.OptionMenu, printer_var: tk.StringVar, printers: List[str]):
+    """Enumerate printers off the Tk thread and hand the result back to it."""
+    found = list_printers()
+    if found:
+        _write_printer_cache(found)
+
+    def done():
+        # An empty result is usually a transient spooler/CUPS hiccup: keep the
+        # cached printers already on screen instead of wiping the menu
+        if not found and printers:
+            return
+        printers[:] = found
+        _populate_menu(printer_menu, printer_var, printers)
+
+    try:
+        root.after(0, done)
+    except (RuntimeError, tk.TclError):
+        # The window was closed before enumeration finished
+        pass
+
+
 def create_gui():
     """Set up and run the Tkinter GUI."""
-    printers = list_printers()
+    printers = []  # type: List[str]
     root = tk.Tk()
     root.title("Impressora Universal de Etiquetas")
     root.geometry("560x240")
@@ -191,17 +505,19 @@ def create_gui():
     )
     tk.Label(root, text=description, wraplength=540, justify="left", pady=10).pack()
 
-    # Printer selection
+    # Printer selection: the menu stays disabled until the cached or live list is loaded
     frame = tk.Frame(root)
     frame.pack(pady=5)
     tk.Label(frame, text="Impressora:").pack(side="left")
-    printer_var = tk.StringVar(value=printers[0] if printers else "")
-    if printers:
-        global selected_printer
-        selected_printer = printers[0]
-    printer_menu = tk.OptionMenu(frame, printer_var, *printers, command=lambda _: on_printer_select(_, printer_var))
-    printer_menu.config(width=40)
+    loading = "Carregando impressoras…"
+    printer_var = tk.StringVar(value=loading)
+    printer_menu = tk.OptionMenu(frame, printer_var, loading)
+    printer_menu.config(width=40, state="disabled")
     printer_menu.pack(side="left", padx=10)
+    cached = _read_printer_cache()
+    if cached:
+        printers[:] = cached
+        _populate_menu(printer_menu, printer_var, printers)
 
     # Test mode checkbox
     test_var = tk.IntVar(value=1)
@@ -216,6 +532,16 @@ def create_gui():
         width=35,
     ).pack(pady=10)
 
+    # Printer enumeration can block on the spooler/network, keep it off the Tk thread
+    threading.Thread(
+        target=_load_printers_bg, args=(root, printer_menu, printer_var, printers), daemon=True
+    ).start()
+
+    def on_close():
+        _close_handle()
+        root.destroy()
+
+    root.protocol("WM_DELETE_WINDOW", on_close)
     root.mainloop()
 
 
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import main
+
+
+class SplitZplLabelsTest(unittest.TestCase):
+    def test_keeps_commands_outside_label_blocks(self):
+        content = b"~DGR:LOGO.GRF,2,1,FF\n^XA^FO10,10^XGR:LOGO.GRF^FS^XZ\n^XA^XZ"
+        labels = main.split_zpl_labels(content)
+        self.assertEqual(len(labels), 2)
+        self.assertTrue(labels[0].startswith(b"~DGR:LOGO.GRF"))
+
+    def test_closes_unterminated_trailing_block(self):
+        labels = main.split_zpl_labels(b"^XA a ^XZ\n  \n^XZ^XA b")
+        self.assertEqual(len(labels), 2)
+        self.assertTrue(labels[1].startswith(b"^XA b^XZ"))
+
+    def test_missing_terminator_is_linear(self):
+        # Regression: an unbounded lazy scan made this quadratic (minutes)
+        content = b"^XA" + b"A" * 200_000
+        start = time.perf_counter()
+        labels = main.split_zpl_labels(content)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual(len(labels), 1)
+        self.assertTrue(labels[0].startswith(content + b"^XZ"))
+
+
+class PrintLabelsTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".zpl")
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    def write(self, data):
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def test_rejects_large_non_zpl_file_quickly(self):
+        self.write(b"not a label " * 20_000)
+        start = time.perf_counter()
+        with mock.patch.object(main, "send_raw_to_printer") as send:
+            with self.assertRaises(RuntimeError):
+                main.print_labels(self.path, "zebra", False)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        send.assert_not_called()
+
+    def test_unterminated_label_in_test_mode_is_linear(self):
+        self.write(b"^XA" + b"A" * 200_000)
+        start = time.perf_counter()
+        with mock.patch.object(main, "send_raw_to_printer") as send:
+            main.print_labels(self.path, "zebra", True)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        send.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()